@@ -0,0 +1,21 @@
+"""
+Compila ahead-of-time (AOT) os kernels de indicadores em um módulo nativo `_ta_kernels`.
+
+Execute `python build_kernels.py` na etapa de build da imagem de deploy. O projetocall.py
+importa `_ta_kernels` quando ele existe e, caso contrário, recorre ao JIT do Numba.
+As assinaturas abaixo precisam acompanhar os tipos usados nas chamadas em projetocall.py.
+"""
+import os
+
+from numba.pycc import CC
+
+import indicadores
+
+cc = CC('_ta_kernels')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+cc.export('wilder_rsi', 'f4[:](f4[:], i8)')(indicadores.wilder_rsi)
+cc.export('rolling_mean', 'f8[:](i8[:], i8)')(indicadores.rolling_mean)
+
+if __name__ == "__main__":
+    cc.compile()
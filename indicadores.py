@@ -0,0 +1,58 @@
+"""
+Kernels numéricos dos indicadores técnicos.
+
+As funções são escritas em Python puro no subconjunto suportado pelo Numba, para
+serem compiladas tanto por JIT (projetocall.py) quanto ahead-of-time (build_kernels.py).
+"""
+import numpy as np
+
+def wilder_rsi(close, n):
+    """
+    Calcula o IFR (RSI) com a suavização de Wilder em uma única passada.
+    As primeiras `n` variações formam a média simples inicial de ganhos e perdas;
+    as seguintes usam avg = (avg * (n - 1) + x) / n. Barras sem histórico suficiente ficam NaN.
+    Recebe e devolve float32, mas acumula as médias em float64.
+    """
+    out = np.full(close.size, np.nan, dtype=np.float32)
+    if close.size <= n:
+        return out
+
+    avg_g = 0.0
+    avg_l = 0.0
+    for i in range(1, n + 1):
+        delta = float(close[i]) - float(close[i - 1])
+        if delta > 0:
+            avg_g += delta
+        else:
+            avg_l -= delta
+    avg_g /= n
+    avg_l /= n
+
+    for i in range(n, close.size):
+        if i > n:
+            delta = float(close[i]) - float(close[i - 1])
+            ganho = delta if delta > 0 else 0.0
+            perda = -delta if delta < 0 else 0.0
+            avg_g = (avg_g * (n - 1) + ganho) / n
+            avg_l = (avg_l * (n - 1) + perda) / n
+        if avg_l == 0.0:
+            out[i] = 100.0
+        else:
+            out[i] = 100.0 - 100.0 / (1.0 + avg_g / avg_l)
+    return out
+
+def rolling_mean(x, n):
+    """
+    Média móvel simples por soma acumulada: uma soma e uma subtração por barra.
+    Recebe inteiros (int64) e mantém a soma exata em inteiro, dividindo apenas na saída.
+    As primeiras `n - 1` posições ficam NaN, como no `rolling(n).mean()` do pandas.
+    """
+    out = np.full(x.size, np.nan)
+    soma = 0
+    for i in range(x.size):
+        soma += x[i]
+        if i >= n:
+            soma -= x[i - n]
+        if i >= n - 1:
+            out[i] = soma / n
+    return out
@@ -1,11 +1,17 @@
 import streamlit as st
 import yfinance as yf
-import pandas_ta as ta
-import mplfinance as mpf
+import numpy as np
 import pandas as pd
-from datetime import date, timedelta, datetime
+from curl_cffi import requests as curl_requests
+from collections import OrderedDict
+from datetime import date, timedelta, datetime, time
 from io import BytesIO
-import pytz
+from pathlib import Path
+import os
+import threading
+from zoneinfo import ZoneInfo
+
+import indicadores
 
 # =================================================================
 # CONSTANTES E CONFIGURAÇÕES
@@ -14,165 +20,598 @@ RSI_PERIOD = 9
 MA_SHORT = 21
 MA_LONG = 50
 PROXIMITY_TOLERANCE = 0.015
-TIMEZONE = pytz.timezone('America/Sao_Paulo')
+TIMEZONE = ZoneInfo('America/Sao_Paulo')
+B3_CLOSE_TIME = time(17, 30)
+CACHE_DIR = Path(__file__).parent / '.cache'
+# Idade a partir da qual um arquivo temporário do cache em disco é tido como abandonado
+CACHE_TMP_MAX_IDADE = timedelta(hours=1)
 
 # Lista de ativos populares para facilitar a seleção do usuário
 ASSET_LIST = [
     "PETR4", "VALE3", "ITUB4", "BBDC4", "ABEV3", "WEGE3",
     "MGLU3", "VIIA3", "B3SA3", "SUZB3", "GGBR4", "JBSS3"
 ]
+# Histórico pré-carregado dos ativos populares (cobre o maior período de análise)
+PREWARM_PERIOD = "2y"
+HTTP_TIMEOUT = 10
+# Únicas colunas do provedor usadas pela análise e pelo gráfico
+OHLCV_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+# Valores da última barra usados pelo relatório, nesta ordem
+REPORT_COLUMNS = ['Close', 'RSI', 'PP', 'R1', 'S1', 'R2', 'S2']
+# Máximo de candles desenhados no gráfico (as barras mais recentes)
+MAX_PLOT_BARS = 250
+# Máximo de gráficos (PNG) mantidos no cache do Streamlit
+PLOT_CACHE_MAX_ENTRIES = 64
+# Máximo de relatórios formatados mantidos no cache do Streamlit
+REPORT_CACHE_MAX_ENTRIES = 512
+
+# Recomendação, nível de entrada e justificativa do IFR para cada código de classificar_sinais
+_JUSTIFICATIVA_NEUTRA = "IFR({periodo}) atual ({ifr:.2f}) indica condições neutras."
+_SINAIS = (
+    ("**COMPRA AGRESSIVA / LONG**", 'S1', "IFR({periodo}) ({ifr:.2f}) está em zona de **Sobre-Venda (< 35)**."),
+    ("**VENDA AGRESSIVA / SHORT**", 'R1', "IFR({periodo}) ({ifr:.2f}) está em zona de **Sobre-Compra (> 65)**."),
+    ("**COMPRA MODERADA**", 'S1', _JUSTIFICATIVA_NEUTRA),
+    ("**VENDA MODERADA**", 'R1', _JUSTIFICATIVA_NEUTRA),
+    ("**NEUTRA / AGUARDAR**", None, _JUSTIFICATIVA_NEUTRA),
+)
+_SINAL_NEUTRO = 4
+
+# Modelos do relatório: formatados com str.format a partir de valores já calculados
+_MODELO_RELATORIO = (
+    "{cabecalho}\n"
+    "**Análise Gerada em:** {hora_analise} (Fonte: Yahoo Finance)\n"
+    "\n"
+    "{corpo}"
+)
+_MODELO_CABECALHO = (
+    "### Análise para {ativo}\n"
+    "**Preço de Fechamento:** R$ {fechamento:.2f} (em {data_fechamento})"
+)
+_MODELO_CORPO = (
+    "**Ponto de Pivô (PP):** R$ {pp:.2f}\n"
+    "**Suporte Imediato (S1):** R$ {s1:.2f}\n"
+    "**Resistência Imediata (R1):** R$ {r1:.2f}\n"
+    "\n"
+    "#### Análise da Tendência e IFR\n"
+    "O ativo está entre o Suporte 1 (S1) e a Resistência 1 (R1).\n"
+    "- **Índice de Força Relativa:** {justificativa_ifr}\n"
+    "\n"
+    "#### Recomendação de Ação\n"
+    "{recomendacao}\n"
+    "---\n"
+    "**Próximos Níveis:** Suporte 2 (R$ {s2:.2f}) e Resistência 2 (R$ {r2:.2f})."
+)
+_MODELO_RECOMENDACAO = (
+    "Com base na combinação de preço e IFR, a recomendação é de **{acao}**.\n"
+    "Ponto de entrada sugerido: **R$ {nivel_entrada:.2f}** (operar próximo da zona de reversão)."
+)
+_RECOMENDACAO_AGUARDAR = "**Aguardar:** Não há um sinal claro. Recomenda-se esperar o preço se aproximar de S1 ou R1.\n"
+
+# Máximo de conjuntos de indicadores memorizados no processo
+INDICADORES_MAX_ENTRADAS = 64
+
+# Limites do histórico incremental por ativo: quantidade de ativos e idade do último download completo
+HISTORICO_MAX_ATIVOS = 32
+HISTORICO_MAX_IDADE = timedelta(days=7)
+
+
+# =================================================================
+# KERNELS NUMÉRICOS DOS INDICADORES
+# =================================================================
+
+@st.cache_resource
+def _kernels():
+    """
+    Carrega os kernels dos indicadores uma única vez por processo: o Streamlit reexecuta este
+    script a cada rerun, e criar os dispatchers do Numba no nível do módulo os recompilaria
+    (ou os releria do cache em disco) a cada interação.
+    Retorna a tupla (wilder_rsi, rolling_mean).
+    """
+    try:
+        # Kernels pré-compilados (AOT) por build_kernels.py na imagem de deploy
+        from _ta_kernels import wilder_rsi, rolling_mean
+    except ImportError:
+        # Sem o módulo compilado, usa o JIT do Numba e aquece os kernels já aqui,
+        # para que a primeira análise não pague a compilação
+        from numba import njit
+        wilder_rsi = njit(cache=True, fastmath=True)(indicadores.wilder_rsi)
+        rolling_mean = njit(cache=True)(indicadores.rolling_mean)
+        wilder_rsi(np.linspace(1.0, 2.0, 32, dtype=np.float32), RSI_PERIOD)
+        rolling_mean(np.arange(32, dtype=np.int64), MA_SHORT)
+    return wilder_rsi, rolling_mean
 
 # =================================================================
 # FUNÇÕES DE PROCESSAMENTO E ANÁLISE DE DADOS
 # =================================================================
 
-@st.cache_data(ttl=900) # Cache de 15 minutos
-def carregar_e_processar_dados(ticker: str, start_date: date, end_date: date):
+class DadosIndisponiveis(Exception):
     """
-    Baixa os dados do ativo, calcula os indicadores técnicos e retorna um DataFrame.
-    Retorna um DataFrame processado ou None em caso de erro.
+    Falha ao obter os dados do ativo; a mensagem é exibida ao usuário.
     """
+
+def _mensagem_sem_dados(ticker: str) -> str:
+    """
+    Mensagem exibida quando o provedor não tem dados do ativo no período.
+    """
+    return f"Não foram encontrados dados para o ativo **{ticker.replace('.SA', '')}** no período selecionado."
+
+def _ultimo_fechamento_b3() -> datetime:
+    """
+    Retorna o instante do último fechamento do pregão da B3 (dias úteis, horário de Brasília).
+    """
+    agora = datetime.now(TIMEZONE)
+    fechamento = agora.replace(hour=B3_CLOSE_TIME.hour, minute=B3_CLOSE_TIME.minute, second=0, microsecond=0)
+    if agora < fechamento:
+        fechamento -= timedelta(days=1)
+    while fechamento.weekday() >= 5:
+        fechamento -= timedelta(days=1)
+    return fechamento
+
+def _caminho_cache_disco(ticker: str, start_date: date, end_date: date) -> Path:
+    """
+    Monta o caminho do arquivo de cache em disco para o ativo e o período.
+    """
+    return CACHE_DIR / f"{ticker}_{start_date}_{end_date}.parquet"
+
+def _ler_cache_disco(ticker: str, start_date: date, end_date: date):
+    """
+    Lê os dados OHLCV persistidos em disco, desde que tenham sido gravados após o último pregão.
+    Retorna um DataFrame ou None se não houver cache válido.
+    """
+    caminho = _caminho_cache_disco(ticker, start_date, end_date)
     try:
-        df = yf.download(ticker, start=start_date, end=end_date, auto_adjust=False)
-        if df.empty:
-            st.error(f"Não foram encontrados dados para o ativo **{ticker.replace('.SA', '')}** no período selecionado.")
+        if caminho.stat().st_mtime < _ultimo_fechamento_b3().timestamp():
             return None
-    except Exception as e:
-        st.error(f"Ocorreu um erro ao buscar os dados: {e}")
+        return pd.read_parquet(caminho)
+    except Exception:
+        # Arquivo inexistente ou corrompido: basta baixar novamente
         return None
 
-    # --- LÓGICA DE LIMPEZA DE COLUNAS ROBUSTA ---
-    # yfinance pode retornar colunas como MultiIndex (tuplas) ou strings.
-    # Esta lógica lida com ambos os casos para extrair os nomes corretos.
-    cleaned_columns = []
-    for col in df.columns:
-        if isinstance(col, tuple):
-            # Se for uma tupla como ('High', 'PETR4.SA'), pegamos o primeiro elemento 'High'
-            cleaned_columns.append(col[0])
-        else:
-            # Se for uma string, apenas a usamos
-            cleaned_columns.append(str(col))
-    df.columns = cleaned_columns
-
-    # Garante que as colunas estão com nomes padronizados (ex: 'open' -> 'Open')
+def _gravar_cache_disco(df: pd.DataFrame, ticker: str, start_date: date, end_date: date):
+    """
+    Persiste os dados OHLCV em Parquet (zstd) para reaproveitamento entre processos e reinícios.
+    """
+    caminho = _caminho_cache_disco(ticker, start_date, end_date)
+    # Grava em um arquivo temporário e renomeia: outros workers nunca leem um Parquet pela metade
+    temporario = caminho.with_name(f"{caminho.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        df.to_parquet(temporario, compression='zstd')
+        temporario.replace(caminho)
+    except Exception:
+        # O cache em disco é apenas uma otimização; falhas de escrita não interrompem a análise
+        temporario.unlink(missing_ok=True)
+        return
+    _limpar_cache_disco()
+
+def _limpar_cache_disco():
+    """
+    Remove os arquivos de cache cuja data final é anterior a hoje (a chave muda a cada dia
+    e eles nunca mais seriam lidos) e os temporários abandonados por gravações interrompidas.
+    """
+    # Mesma fonte de data da chave montada em main(): um relógio em outro fuso apagaria o arquivo recém-gravado
+    hoje = date.today()
+    for arquivo in CACHE_DIR.glob('*.parquet'):
+        try:
+            _, _, fim = arquivo.stem.rsplit('_', 2)
+            if date.fromisoformat(fim) < hoje:
+                arquivo.unlink(missing_ok=True)
+        except (ValueError, OSError):
+            # Nome fora do padrão ou arquivo em uso: fica para a próxima limpeza
+            continue
+
+    # Só remove temporários antigos: os recentes podem ser gravações em andamento de outros workers
+    limite = (datetime.now() - CACHE_TMP_MAX_IDADE).timestamp()
+    for arquivo in CACHE_DIR.glob('*.tmp'):
+        try:
+            if arquivo.stat().st_mtime < limite:
+                arquivo.unlink(missing_ok=True)
+        except OSError:
+            continue
+
+def _baixar_ohlcv(ticker: str, start_date: date, end_date: date, avisar_vazio: bool = True):
+    """
+    Baixa os dados diários do ativo no Yahoo Finance.
+    Com `avisar_vazio` False, um período sem pregões devolve None em vez de ser tratado como erro.
+    Retorna um DataFrame; levanta DadosIndisponiveis em caso de erro.
+    """
     try:
-        df.columns = [col.strip().title() for col in df.columns]
+        # Ticker.history devolve colunas simples para um único ativo, dispensando o achatamento do MultiIndex.
+        # Sem proventos nem pré/pós-mercado: só o OHLCV diário
+        df = yf.Ticker(ticker, session=_sessao_yf()).history(
+            start=start_date, end=end_date, auto_adjust=False, actions=False, prepost=False, timeout=HTTP_TIMEOUT
+        )
     except Exception as e:
-        st.error(f"Não foi possível padronizar os nomes das colunas. Erro: {e}")
-        st.warning(f"Colunas recebidas do provedor de dados: {list(df.columns)}")
+        raise DadosIndisponiveis(f"Ocorreu um erro ao buscar os dados: {e}") from e
+    if df.empty:
+        if avisar_vazio:
+            raise DadosIndisponiveis(_mensagem_sem_dados(ticker))
         return None
 
+    # Mantém apenas as colunas OHLCV (descarta 'Adj Close')
+    df = df[[col for col in OHLCV_COLUMNS if col in df.columns]]
+
+    # history devolve as datas no fuso da bolsa; pré-carga e cache em disco usam datas sem fuso
+    if df.index.tz is not None:
+        df.index = df.index.tz_localize(None)
+
     # Verifica se as colunas essenciais para o cálculo existem
     required_cols = ['High', 'Low', 'Close', 'Volume']
     if not all(col in df.columns for col in required_cols):
-        st.error("Os dados recebidos não contêm as colunas essenciais (High, Low, Close, Volume) após a padronização.")
-        st.info(f"Colunas encontradas: {list(df.columns)}")
+        raise DadosIndisponiveis("Os dados recebidos não contêm as colunas essenciais (High, Low, Close, Volume). "
+                                 f"Colunas encontradas: {list(df.columns)}")
+
+    return df
+
+@st.cache_resource
+def _sessao_yf():
+    """
+    Sessão HTTP compartilhada por todos os downloads do yfinance (keep-alive e pool de conexões),
+    evitando um novo handshake TCP/TLS a cada requisição.
+    """
+    return curl_requests.Session(impersonate="chrome", timeout=HTTP_TIMEOUT)
+
+@st.cache_resource(max_entries=1)
+def _pre_carregar_ativos_populares(pregao: str) -> dict:
+    """
+    Dispara em segundo plano um único download em lote dos ativos de ASSET_LIST.
+    `pregao` identifica o último fechamento da B3: a cada novo pregão encerrado a chave muda
+    e o lote é baixado novamente, descartando o anterior.
+    Retorna o dicionário {ticker: DataFrame}, preenchido quando o download termina.
+    """
+    historicos = {}
+    sessao = _sessao_yf()
+
+    def _baixar_lote():
+        try:
+            dados = yf.download([f"{ativo}.SA" for ativo in ASSET_LIST], period=PREWARM_PERIOD,
+                                group_by='ticker', threads=True, auto_adjust=False, progress=False,
+                                session=sessao)
+        except Exception:
+            # Sem pré-carga, cada ativo é baixado individualmente sob demanda
+            return
+        for ticker in dados.columns.get_level_values(0).unique():
+            # Guarda apenas OHLCV: 'Adj Close' não é usado e só ocuparia memória e cache
+            historico = dados[ticker]
+            historico = historico[[col for col in OHLCV_COLUMNS if col in historico.columns]]
+            historicos[ticker] = historico.dropna(how='all')
+
+    threading.Thread(target=_baixar_lote, daemon=True).start()
+    return historicos
+
+def _ultimo_pregao_antes(end_date: date) -> date:
+    """
+    Retorna a data do último pregão já encerrado anterior a `end_date` (exclusiva), ignorando feriados.
+    """
+    pregao = _ultimo_fechamento_b3().date()
+    if pregao >= end_date:
+        pregao = end_date - timedelta(days=1)
+        while pregao.weekday() >= 5:
+            pregao -= timedelta(days=1)
+    return pregao
+
+def _recortar_pre_carregado(ticker: str, start_date: date, end_date: date):
+    """
+    Recorta o período pedido do histórico pré-carregado, se ele estiver disponível e o cobrir
+    do início até o último pregão encerrado antes de `end_date`.
+    Retorna um DataFrame ou None.
+    """
+    historico = _pre_carregar_ativos_populares(_ultimo_fechamento_b3().isoformat()).get(ticker)
+    inicio, fim = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    if historico is None or historico.empty or historico.index[0] > inicio:
         return None
 
-    # Calcula Pontos de Pivô Clássico
-    df['PP'] = (df['High'] + df['Low'] + df['Close']) / 3
-    df['R1'] = (2 * df['PP']) - df['Low']
-    df['S1'] = (2 * df['PP']) - df['High']
-    df['R2'] = df['PP'] + (df['High'] - df['Low'])
-    df['S2'] = df['PP'] - (df['High'] - df['Low'])
+    # Assim como no yf.download, a data final é exclusiva
+    recorte = historico[(historico.index >= inicio) & (historico.index < fim)]
 
-    # Calcula IFR (RSI)
-    df.ta.rsi(length=RSI_PERIOD, append=True)
-    df.rename(columns={f'RSI_{RSI_PERIOD}': 'RSI'}, inplace=True)
+    # A última barra precisa ser o último pregão encerrado: uma barra parcial (lote baixado com o
+    # mercado aberto) ou ausente (feriado, falha do provedor) faz a busca seguir para o disco/rede
+    if recorte.empty or recorte.index[-1].date() != _ultimo_pregao_antes(end_date):
+        return None
+    return recorte.copy()
 
-    # Calcula Média Móvel de Volume
-    df['Volume_MA'] = df['Volume'].rolling(window=MA_SHORT).mean()
+@st.cache_resource
+def _historico_por_ativo():
+    """
+    Histórico baixado por ativo neste processo: {ticker: (data inicial, data do download completo, DataFrame)}.
+    Fica no st.cache_resource porque o Streamlit reexecuta este script como um novo módulo a cada
+    rerun: um dicionário global seria recriado vazio e nunca chegaria a ser lido.
+    Retorna a tupla (OrderedDict, Lock); as sessões rodam em threads e o acessam sob a trava.
+    """
+    return OrderedDict(), threading.Lock()
 
+def _baixar_incremental(ticker: str, start_date: date, end_date: date):
+    """
+    Reaproveita o histórico já baixado do ativo neste processo e busca no Yahoo Finance
+    apenas as barras a partir da última conhecida. Essa barra é comparada com a nova versão:
+    se o provedor reajustou o passado (desdobramentos, correções) ou o histórico tem mais de
+    HISTORICO_MAX_IDADE, tudo é baixado novamente.
+    Retorna um DataFrame com o período pedido; levanta DadosIndisponiveis em caso de erro.
+    """
+    historico = None
+    registro = _obter_memorizado(_historico_por_ativo(), ticker)
+    if registro is not None:
+        inicio_conhecido, baixado_em, historico = registro
+        if inicio_conhecido > start_date or date.today() - baixado_em > HISTORICO_MAX_IDADE:
+            historico = None
+
+    if historico is not None:
+        ultima = historico.index[-1]
+        if ultima.date() + timedelta(days=1) < end_date:
+            novas = _baixar_ohlcv(ticker, ultima.date(), end_date, avisar_vazio=False)
+            confere = (novas is not None and novas.index[0] == ultima
+                       and np.isclose(novas['Close'].iloc[0], historico['Close'].iloc[-1]))
+            if confere:
+                historico = pd.concat([historico.iloc[:-1], novas])
+                historico = historico[~historico.index.duplicated(keep='last')]
+            else:
+                historico = None
+
+    if historico is None:
+        # Primeiro acesso, período mais antigo que o conhecido, histórico velho ou divergente: download completo
+        historico = _baixar_ohlcv(ticker, start_date, end_date)
+        inicio_conhecido, baixado_em = start_date, date.today()
+    _memorizar(_historico_por_ativo(), ticker, (inicio_conhecido, baixado_em, historico), HISTORICO_MAX_ATIVOS)
+
+    # Assim como no yf.download, a data final é exclusiva
+    recorte = historico[(historico.index >= pd.Timestamp(start_date)) & (historico.index < pd.Timestamp(end_date))]
+    if recorte.empty:
+        raise DadosIndisponiveis(_mensagem_sem_dados(ticker))
+    return recorte.copy()
+
+@st.cache_data(ttl=timedelta(hours=8)) # Os dados são diários; o cache em disco controla a validade por pregão
+def _carregar_ohlcv(ticker: str, start_date: date, end_date: date):
+    """
+    Obtém os dados OHLCV da pré-carga dos ativos populares, do cache em disco ou,
+    se necessário, do Yahoo Finance (de forma incremental).
+    Retorna um DataFrame. Falhas levantam DadosIndisponiveis, que o st.cache_data não memoriza:
+    um erro momentâneo do provedor não bloqueia o ativo até o fim do TTL.
+    """
+    df = _recortar_pre_carregado(ticker, start_date, end_date)
+    if df is None:
+        df = _ler_cache_disco(ticker, start_date, end_date)
+    if df is None:
+        df = _baixar_incremental(ticker, start_date, end_date)
+        _gravar_cache_disco(df, ticker, start_date, end_date)
+
+    # Preços em float32: metade dos bytes por passada e precisão de sobra para centavos.
+    # Volume em int64: é uma contagem e alimenta a média móvel por soma inteira
+    precos = [col for col in ('Open', 'High', 'Low', 'Close') if col in df.columns]
+    df[precos] = df[precos].astype(np.float32)
+    df['Volume'] = df['Volume'].fillna(0).astype(np.int64)
     return df
 
-def gerar_relatorio_analise(df: pd.DataFrame, ticker_name: str):
+def _obter_memorizado(armazenamento, chave):
     """
-    Gera um relatório estruturado com análise técnica, recomendação e níveis de preço.
+    Lê uma entrada de um cache limitado em memória, marcando-a como usada recentemente.
+    `armazenamento` é a tupla (OrderedDict, Lock) do cache.
+    Retorna o valor ou None.
     """
-    if df is None or df.empty:
-        return "Erro: DataFrame vazio ou inválido."
+    cache, trava = armazenamento
+    with trava:
+        valor = cache.get(chave)
+        if valor is not None:
+            cache.move_to_end(chave)
+        return valor
+
+def _memorizar(armazenamento, chave, valor, limite: int):
+    """
+    Grava uma entrada em um cache limitado em memória, descartando as menos usadas acima de `limite`.
+    `armazenamento` é a tupla (OrderedDict, Lock) do cache.
+    """
+    cache, trava = armazenamento
+    with trava:
+        cache[chave] = valor
+        cache.move_to_end(chave)
+        while len(cache) > limite:
+            cache.popitem(last=False)
+
+@st.cache_resource
+def _indicadores_memorizados():
+    """
+    Indicadores já calculados: {(ticker, início, fim, barras, última barra, média de volume): arrays}.
+    Assim como o histórico incremental, fica no st.cache_resource para sobreviver aos reruns
+    e ser compartilhado entre as sessões.
+    Retorna a tupla (OrderedDict, Lock).
+    """
+    return OrderedDict(), threading.Lock()
 
-    dados_atuais = df.iloc[-1]
-    fechamento = dados_atuais['Close']
-    data_fechamento = df.index[-1].strftime('%d/%m/%Y')
-    hora_analise = datetime.now(TIMEZONE).strftime('%d/%m/%Y às %H:%M:%S')
+def _calcular_indicadores(df: pd.DataFrame, include_volume_ma: bool):
+    """
+    Calcula pivôs, IFR e (opcionalmente) a média de volume a partir dos dados OHLCV.
+    Retorna uma tupla (pivos, rsi, volume_ma) de arrays somente leitura.
+    """
+    wilder_rsi, rolling_mean = _kernels()
+
+    # Extrai uma única vez os vetores usados pelos indicadores
+    high = np.ascontiguousarray(df['High'].to_numpy())
+    low = np.ascontiguousarray(df['Low'].to_numpy())
+    close = np.ascontiguousarray(df['Close'].to_numpy())
+
+    # Calcula Pontos de Pivô Clássico em um único bloco NumPy
+    pp = (high + low + close) * (1.0 / 3.0)
+    amplitude = high - low
+    pivos = np.empty((close.size, 5), dtype=np.float32)
+    pivos[:, 0] = pp
+    pivos[:, 1] = 2 * pp - low
+    pivos[:, 2] = 2 * pp - high
+    pivos[:, 3] = pp + amplitude
+    pivos[:, 4] = pp - amplitude
+
+    # Calcula IFR (RSI) de Wilder com o kernel compilado
+    rsi = wilder_rsi(close, RSI_PERIOD)
+
+    # Calcula Média Móvel de Volume (opcional) com soma acumulada em inteiros
+    volume_ma = None
+    if include_volume_ma:
+        volume = df['Volume'].to_numpy()
+        volume_ma = rolling_mean(volume, MA_SHORT)
+
+    # Os arrays são compartilhados entre chamadas: ficam protegidos contra escrita
+    for valores in (pivos, rsi, volume_ma):
+        if valores is not None:
+            valores.flags.writeable = False
+    return pivos, rsi, volume_ma
+
+def carregar_e_processar_dados(ticker: str, start_date: date, end_date: date, include_volume_ma: bool = False):
+    """
+    Baixa os dados do ativo, calcula os indicadores técnicos e retorna um DataFrame.
+    A média móvel de volume só é calculada quando `include_volume_ma` é True,
+    pois nem o relatório nem o gráfico a utilizam.
+    Retorna um DataFrame processado ou None em caso de erro.
+    """
+    try:
+        df = _carregar_ohlcv(ticker, start_date, end_date)
+    except DadosIndisponiveis as e:
+        st.error(str(e))
+        return None
 
-    # Checagem de segurança para indicadores
-    ifr = dados_atuais.get('RSI')
-    r1 = dados_atuais.get('R1')
-    s1 = dados_atuais.get('S1')
-    r2 = dados_atuais.get('R2')
-    s2 = dados_atuais.get('S2')
-    pp = dados_atuais.get('PP')
-
-    if any(v is None for v in [ifr, r1, s1, r2, s2, pp]):
-        return "Erro: Não foi possível calcular todos os indicadores necessários."
+    # Indicadores memorizados no processo, sem passar por pickle. A chave inclui a quantidade de barras
+    # e a data da última barra, de modo que uma atualização dos dados nunca reaproveite indicadores
+    # de outra versão do histórico
+    chave = (ticker, start_date.toordinal(), end_date.toordinal(), len(df), df.index[-1].value, include_volume_ma)
+    resultado = _obter_memorizado(_indicadores_memorizados(), chave)
+    if resultado is None:
+        resultado = _calcular_indicadores(df, include_volume_ma)
+        _memorizar(_indicadores_memorizados(), chave, resultado, INDICADORES_MAX_ENTRADAS)
+
+    pivos, rsi, volume_ma = resultado
+    df[['PP', 'R1', 'S1', 'R2', 'S2']] = pivos
+    df['RSI'] = rsi
+    if volume_ma is not None:
+        df['Volume_MA'] = volume_ma
+
+    return df
+
+def classificar_sinais(fechamento, ifr, s1, r1):
+    """
+    Classifica cada barra com um único np.select, aceitando escalares ou séries inteiras.
+    Códigos: 0 compra agressiva, 1 venda agressiva, 2 compra moderada, 3 venda moderada, 4 neutro.
+    """
+    fechamento, ifr, s1, r1 = (np.asarray(v, dtype=np.float64) for v in (fechamento, ifr, s1, r1))
+    condicoes = [
+        (fechamento <= s1 + (s1 * PROXIMITY_TOLERANCE)) & (ifr < 35),
+        (fechamento >= r1 - (r1 * PROXIMITY_TOLERANCE)) & (ifr > 65),
+        fechamento <= s1,
+        fechamento >= r1,
+    ]
+    return np.select(condicoes, [0, 1, 2, 3], default=_SINAL_NEUTRO)
 
+def _extrair_valores_relatorio(df: pd.DataFrame):
+    """
+    Extrai da última barra a data (em nanossegundos) e os valores de REPORT_COLUMNS, como escalares.
+    Uma única extração em float64 e um único teste de NaN.
+    Retorna uma tupla ou None se faltar algum indicador.
+    """
+    if not all(col in df.columns for col in REPORT_COLUMNS):
+        return None
+    # Lê só a última linha: df[REPORT_COLUMNS] copiaria o histórico inteiro para usar uma barra
+    ultimo = df.iloc[-1, df.columns.get_indexer(REPORT_COLUMNS)].to_numpy(dtype=np.float64)
+    if np.isnan(ultimo).any():
+        return None
+    return (df.index[-1].value, *(float(v) for v in ultimo))
+
+# No st.cache_data, e não em um lru_cache do módulo, que o Streamlit recriaria vazio a cada rerun
+@st.cache_data(max_entries=REPORT_CACHE_MAX_ENTRIES)
+def _formatar_relatorio(ticker_name: str, ts_ns: int, fechamento: float, ifr: float,
+                        pp: float, r1: float, s1: float, r2: float, s2: float):
+    """
+    Formata o relatório a partir dos valores escalares da última barra, memorizando o resultado entre reruns.
+    Retorna (cabeçalho, corpo); o horário da análise, única parte que muda a cada chamada,
+    é inserido entre os dois por gerar_relatorio_analise.
+    """
     # --- 1. Determinação da Recomendação ---
-    recomendacao_acao = "**NEUTRA / AGUARDAR**"
-    nivel_entrada = 0.0
-    justificativa_ifr = f"IFR({RSI_PERIOD}) atual ({ifr:.2f}) indica condições neutras."
-
-    if fechamento <= s1 + (s1 * PROXIMITY_TOLERANCE) and ifr < 35:
-        recomendacao_acao = "**COMPRA AGRESSIVA / LONG**"
-        nivel_entrada = s1
-        justificativa_ifr = f"IFR({RSI_PERIOD}) ({ifr:.2f}) está em zona de **Sobre-Venda (< 35)**."
-    elif fechamento >= r1 - (r1 * PROXIMITY_TOLERANCE) and ifr > 65:
-        recomendacao_acao = "**VENDA AGRESSIVA / SHORT**"
-        nivel_entrada = r1
-        justificativa_ifr = f"IFR({RSI_PERIOD}) ({ifr:.2f}) está em zona de **Sobre-Compra (> 65)**."
-    elif fechamento <= s1:
-        recomendacao_acao = "**COMPRA MODERADA**"
-        nivel_entrada = s1
-    elif fechamento >= r1:
-        recomendacao_acao = "**VENDA MODERADA**"
-        nivel_entrada = r1
+    codigo = int(classificar_sinais(fechamento, ifr, s1, r1))
+    recomendacao_acao, nivel, modelo_justificativa = _SINAIS[codigo]
+    nivel_entrada = {'S1': s1, 'R1': r1}.get(nivel, 0.0)
+    justificativa_ifr = modelo_justificativa.format(periodo=RSI_PERIOD, ifr=ifr)
 
     # --- 2. Montagem do Relatório Estruturado ---
-    relatorio = f"### Análise para {ticker_name.replace('.SA', '')}\n"
-    relatorio += f"**Preço de Fechamento:** R$ {fechamento:.2f} (em {data_fechamento})\n"
-    relatorio += f"**Análise Gerada em:** {hora_analise} (Fonte: Yahoo Finance)\n\n"
-
-    relatorio += f"**Ponto de Pivô (PP):** R$ {pp:.2f}\n"
-    relatorio += f"**Suporte Imediato (S1):** R$ {s1:.2f}\n"
-    relatorio += f"**Resistência Imediata (R1):** R$ {r1:.2f}\n\n"
-
-    relatorio += "#### Análise da Tendência e IFR\n"
-    relatorio += f"O ativo está entre o Suporte 1 (S1) e a Resistência 1 (R1).\n"
-    relatorio += f"- **Índice de Força Relativa:** {justificativa_ifr}\n\n"
-
-    relatorio += "#### Recomendação de Ação\n"
-    if recomendacao_acao != "**NEUTRA / AGUARDAR**":
-        acao_verbo = "COMPRAR" if "COMPRA" in recomendacao_acao else "VENDER"
-        relatorio += f"Com base na combinação de preço e IFR, a recomendação é de **{recomendacao_acao}**.\n"
-        relatorio += f"Ponto de entrada sugerido: **R$ {nivel_entrada:.2f}** (operar próximo da zona de reversão).\n"
+    if codigo != _SINAL_NEUTRO:
+        recomendacao = _MODELO_RECOMENDACAO.format(acao=recomendacao_acao, nivel_entrada=nivel_entrada)
     else:
-        relatorio += "**Aguardar:** Não há um sinal claro. Recomenda-se esperar o preço se aproximar de S1 ou R1.\n\n"
+        recomendacao = _RECOMENDACAO_AGUARDAR
 
-    relatorio += "---\n"
-    relatorio += f"**Próximos Níveis:** Suporte 2 (R$ {s2:.2f}) e Resistência 2 (R$ {r2:.2f})."
+    cabecalho = _MODELO_CABECALHO.format(
+        ativo=ticker_name.replace('.SA', ''),
+        fechamento=fechamento,
+        data_fechamento=pd.Timestamp(ts_ns).strftime('%d/%m/%Y'),
+    )
+    corpo = _MODELO_CORPO.format(
+        pp=pp, s1=s1, r1=r1, s2=s2, r2=r2,
+        justificativa_ifr=justificativa_ifr,
+        recomendacao=recomendacao,
+    )
+    return cabecalho, corpo
 
-    return relatorio
+def gerar_relatorio_analise(df: pd.DataFrame, ticker_name: str):
+    """
+    Gera um relatório estruturado com análise técnica, recomendação e níveis de preço.
+    """
+    if df is None or df.empty:
+        return "Erro: DataFrame vazio ou inválido."
+
+    # Checagem de segurança para indicadores
+    valores = _extrair_valores_relatorio(df)
+    if valores is None:
+        return "Erro: Não foi possível calcular todos os indicadores necessários."
+
+    cabecalho, corpo = _formatar_relatorio(ticker_name, *valores)
+    hora_analise = datetime.now(TIMEZONE).strftime('%d/%m/%Y às %H:%M:%S')
+    return _MODELO_RELATORIO.format(cabecalho=cabecalho, hora_analise=hora_analise, corpo=corpo)
 
 # =================================================================
 # FUNÇÕES DE PLOTAGEM
 # =================================================================
 
+@st.cache_resource
+def _mpf():
+    """
+    Importa o mplfinance (e, com ele, o matplotlib) só quando o primeiro gráfico é gerado,
+    encurtando a inicialização da aplicação.
+    """
+    import matplotlib
+    matplotlib.use('Agg') # Backend sem interface gráfica: evita a detecção de GUI no servidor
+    import mplfinance
+    return mplfinance
+
+@st.cache_resource
+def _estilo_grafico(tema: str):
+    """
+    Constrói o estilo do mplfinance uma única vez por tema, em vez de a cada gráfico.
+    """
+    mpf = _mpf()
+    if tema == 'Escuro':
+        return mpf.make_mpf_style(base_mpf_style='nightclouds', gridstyle=':', y_on_right=False,
+                                  rc={'axes.labelcolor': 'white', 'xtick.color': 'white', 'ytick.color': 'white'})
+    return mpf.make_mpf_style(base_mpf_style='yahoo', gridstyle=':', y_on_right=False)
+
+def _chave_dataframe(df: pd.DataFrame):
+    """
+    Chave de cache barata para o DataFrame: data da última barra e quantidade de barras.
+    """
+    if df.empty:
+        return 0
+    return (df.index[-1].value, len(df))
+
+# Limitado em quantidade e com o mesmo TTL dos dados: PNGs antigos não se acumulam em memória
+@st.cache_data(hash_funcs={pd.DataFrame: _chave_dataframe}, max_entries=PLOT_CACHE_MAX_ENTRIES, ttl=timedelta(hours=8))
 def plotar_grafico(df: pd.DataFrame, ativo_nome: str, tema: str):
     """
     Gera o gráfico e retorna-o como um objeto de bytes para o Streamlit.
+    O PNG é memorizado por ativo, tema e última barra, evitando refazer o gráfico a cada rerun.
     """
     if df is None or df.empty:
         return None
 
+    # pyplot só é importado depois de _mpf(), que define o backend Agg
+    mpf = _mpf()
+    import matplotlib.pyplot as plt
+
     # Configuração de estilo com base no tema
-    if tema == 'Escuro':
-        style = mpf.make_mpf_style(base_mpf_style='nightclouds', gridstyle=':', y_on_right=False,
-                                   rc={'axes.labelcolor': 'white', 'xtick.color': 'white', 'ytick.color': 'white'})
-    else:
-        style = mpf.make_mpf_style(base_mpf_style='yahoo', gridstyle=':', y_on_right=False)
+    style = _estilo_grafico(tema)
 
-    # Níveis de Pivô
+    # Níveis de Pivô (sempre da última barra do histórico completo)
     ultimo_dia = df.iloc[-1]
     pivot_levels = [
         (ultimo_dia['PP'], 'gray', '-', 0.8),
@@ -186,18 +625,21 @@ def plotar_grafico(df: pd.DataFrame, ativo_nome: str, tema: str):
     styles_pivots = [p[2] for p in pivot_levels]
     widths_pivots = [p[3] for p in pivot_levels]
 
+    # O custo de desenho é linear no número de candles; na resolução final não cabem mais que MAX_PLOT_BARS
+    plot_df = df.tail(MAX_PLOT_BARS) if len(df) > MAX_PLOT_BARS else df
+
     # Painel do IFR
     add_plots = []
-    if 'RSI' in df.columns:
+    if 'RSI' in plot_df.columns:
         add_plots.extend([
-            mpf.make_addplot(df['RSI'], panel=2, color='blue', ylabel=f'IFR({RSI_PERIOD})', ylim=(0, 100)),
-            mpf.make_addplot([70] * len(df), panel=2, color='red', linestyle='-.', width=0.7),
-            mpf.make_addplot([30] * len(df), panel=2, color='green', linestyle='-.', width=0.7)
+            mpf.make_addplot(plot_df['RSI'], panel=2, color='blue', ylabel=f'IFR({RSI_PERIOD})', ylim=(0, 100)),
+            mpf.make_addplot(np.full(len(plot_df), 70, dtype=np.float32), panel=2, color='red', linestyle='-.', width=0.7),
+            mpf.make_addplot(np.full(len(plot_df), 30, dtype=np.float32), panel=2, color='green', linestyle='-.', width=0.7)
         ])
 
     buf = BytesIO()
     fig, _ = mpf.plot(
-        df,
+        plot_df,
         type='candle',
         style=style,
         title=f"\nAnálise Técnica: {ativo_nome}",
@@ -220,7 +662,10 @@ def plotar_grafico(df: pd.DataFrame, ativo_nome: str, tema: str):
     # Adiciona a marca d'água
     fig.text(0.5, 0.5, 'Brava', fontsize=60, color='gray', ha='center', va='center', alpha=0.15)
 
-    fig.savefig(buf, format='png', bbox_inches='tight')
+    # 72 DPI bastam para a largura exibida pelo Streamlit e encolhem o PNG
+    fig.savefig(buf, format='png', dpi=72, bbox_inches='tight')
+    # Libera a figura: o pyplot a manteria viva entre os reruns
+    plt.close(fig)
     return buf.getvalue()
 
 # =================================================================
@@ -233,6 +678,11 @@ def main():
     """
     st.set_page_config(page_title="Call Brava", layout="wide")
 
+    # Inicia (uma vez por pregão encerrado) o download em lote dos ativos populares
+    _pre_carregar_ativos_populares(_ultimo_fechamento_b3().isoformat())
+    # Carrega (uma vez por processo) os kernels dos indicadores antes da primeira análise
+    _kernels()
+
     # --- BARRA LATERAL (INPUTS) ---
     with st.sidebar:
         st.image("https://i.imgur.com/vEpA2nO.png", width=70)